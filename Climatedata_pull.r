@@ -1,59 +1,107 @@
-arabidopsis_data <- read.csv("C:\\Users\\ian03\\Desktop\\TerraClimate-1001Genome\\availableplantsforclimate.csv",header = TRUE)
+# column types given up front so read.csv doesn't have to guess them
+arabidopsis_data <- read.csv("C:\\Users\\ian03\\Desktop\\TerraClimate-1001Genome\\availableplantsforclimate.csv",header = TRUE,
+                             colClasses = c("integer","character","numeric","numeric"))
+# no point looking up accessions without coordinates
+arabidopsis_data <- arabidopsis_data[!is.na(arabidopsis_data[,3]) & !is.na(arabidopsis_data[,4]),]
 
 # enter in variable you want to download see: http://thredds.northwestknowledge.net:8080/thredds/terraclimate_aggregated.html
 vars <- list("aet","def","pet","ppt","q","soil","srad","swe","tmax","tmin","vap","ws","vpd","PDSI")
 
 #install it if you need it
 #install.packages("ncdf4")
-#install.packages("zoo")
 library('ncdf4')
-library('zoo')
+library('parallel')
 
-for (i in vars) {
+# index of the nearest grid value for every x in one pass. findInterval needs an
+# ascending grid, terraclimate lat is descending so flip it and map back after.
+# anything further than tol from a grid value comes back NA
+nearest_index <- function(grid, x, tol = 1/48) {
+  flip <- grid[1] > grid[length(grid)]
+  if (flip) grid <- rev(grid)
+  i <- findInterval(x, grid, all.inside = TRUE)
+  i <- ifelse(abs(grid[i + 1] - x) < abs(grid[i] - x), i + 1, i)
+  i[abs(grid[i] - x) >= tol] <- NA
+  if (flip) i <- length(grid) + 1 - i
+  i
+}
+
+# the grid and each variable's pulled series get saved here so reruns don't go back to the server.
+# delete the folder to pick up months published since the last pull
+cache_dir <- "C:\\Users\\ian03\\Desktop\\TerraClimate-1001Genome\\cache"
+dir.create(cache_dir, showWarnings = FALSE)
+
+# the grid is the same for every variable so only look the accessions up once.
+# the lon/lat arrays never change so they get cached too, reruns don't open anything for them
+grid_file <- file.path(cache_dir, "grid.rds")
+if (file.exists(grid_file)) {
+  grid <- readRDS(grid_file)
+} else {
+  nc <- nc_open(paste0(paste0("http://thredds.northwestknowledge.net:8080/thredds/dodsC/agg_terraclimate_",vars[[1]]),"_1958_CurrentYear_GLOBE.nc"))
+  grid <- list(lon = ncvar_get(nc, "lon"), lat = ncvar_get(nc, "lat"))
+  nc_close(nc)
+  saveRDS(grid, grid_file, compress = FALSE)
+}
+# month/year labels are the same for every variable and accession too, made long
+# enough for everything up to this year and cut to the series length later.
+# plain integer math on the month offset, no date objects or string splitting
+months <- seq_len((as.integer(format(Sys.Date(), "%Y")) - 1957) * 12) - 1L
+month_labels <- factor(month.abb[months %% 12L + 1L], levels = month.abb)
+year_labels <- 1958L + months %/% 12L
+latindex <- nearest_index(grid$lat, arabidopsis_data[,3])
+lonindex <- nearest_index(grid$lon, arabidopsis_data[,4])
+no_cell <- is.na(latindex) | is.na(lonindex)
+if (any(no_cell)) print(paste0("No grid cell found for ",paste(arabidopsis_data[no_cell,2],collapse = ", ")))
+# lots of accessions share a grid cell, each cell only needs to come over the wire once
+cell <- paste(lonindex, latindex)
+first_in_cell <- !duplicated(cell) & !no_cell
+
+pull_variable <- function(i) {
   baseurlagg <- paste0(paste0("http://thredds.northwestknowledge.net:8080/thredds/dodsC/agg_terraclimate_",i),"_1958_CurrentYear_GLOBE.nc")
-  nc <- nc_open(baseurlagg)
-  # if you put opening the thing in the Jz loop every time it takes forever forever. 
+  cache_file <- file.path(cache_dir, paste0(i, ".rds"))
+  cell_data <- if (file.exists(cache_file)) readRDS(cache_file) else list()
+  need <- which(first_in_cell & !(cell %in% names(cell_data)))
   
-  export_data <- data.frame(matrix(ncol = 4, nrow = 0))
-  
-  for (j in 1:nrow(arabidopsis_data)) {
-    lon <- ncvar_get(nc, "lon")
-    lat <- ncvar_get(nc, "lat")
-    flat = match(abs(lat - arabidopsis_data[j,3]) < 1/48, 1)
-    latindex = which(flat %in% 1)
-    flon = match(abs(lon - arabidopsis_data[j,4]) < 1/48, 1)
-    lonindex = which(flon %in% 1)
-    start <- c(lonindex, latindex, 1)
-    count <- c(1, 1, -1)
-    
-    # read in the full period of record using aggregated files
-    print(paste0(paste0(paste0("Starting on ",arabidopsis_data[j,2])," in "),i))
-    
-    print("loading data... this takes forever")
-    data <- as.numeric(ncvar_get(nc, varid = i,start = start, count))
-   
-    
-    print("Converting data to df")
-    export_data2 <- as.data.frame(data,colnames=FALSE)
-    print("adding line names")
-    line_names<- rep(c(arabidopsis_data[j,2]),times=nrow(export_data2))
-    line_names<- data.frame(line_names)
-    print("Combining lines")
-    names_and_data <- cbind(line_names,export_data2)
-    print("Adding month/year")
-    names_and_data$month <- head(as.yearmon("Jan 1958") + c(0, seq_len(nrow(names_and_data)))/12, -1)
-    print("splitting...")
-    export_split_dates <- data.frame(do.call('rbind', strsplit(as.character(names_and_data$month),' ',fixed=TRUE)))
-    print("combining months to everything...")
-    names_and_data <- cbind(names_and_data,export_split_dates)
-    names_and_data$month <- NULL
-    
-    print("combining with mother")
-    export_data <- rbind(export_data,names_and_data)
-    
+  if (length(need) > 0) {
+    # lon/lat are already known up top and the time labels are built locally, don't pull them again on every open
+    nc <- nc_open(baseurlagg, suppress_dimvals = TRUE)
+    # if you put opening the thing in the Jz loop every time it takes forever forever. 
+    # cached series from before the server added months can't be mixed with new ones
+    cell_data <- cell_data[lengths(cell_data) == nc$dim$time$len]
+    need <- which(first_in_cell & !(cell %in% names(cell_data)))
     
+    # read in the full period of record for every distinct cell using aggregated files
+    print(paste0(paste0(paste0("loading ",length(need))," cells of "),i))
+    for (k in need) {
+      start <- c(lonindex[k], latindex[k], 1)
+      count <- c(1, 1, -1)
+      cell_data[[cell[k]]] <- as.numeric(ncvar_get(nc, varid = i,start = start, count))
+    }
+    nc_close(nc)
+    # uncompressed, the files are small and gunzipping them every rerun costs more than reading them
+    saveRDS(cell_data, cache_file, compress = FALSE)
   }
+  
+  # build the whole table in one go instead of growing it an accession at a time
+  ok <- which(!no_cell)
+  n_t <- length(cell_data[[1]])
+  # line/month as factors and year as integer, ~800k repeated strings per column otherwise
+  lines <- arabidopsis_data[ok,2]
+  export_data <- data.frame(rep(factor(lines, levels = unique(lines)), each = n_t),
+                            unlist(cell_data[cell[ok]], use.names = FALSE),
+                            rep(month_labels[seq_len(n_t)], times = length(ok)),
+                            rep(year_labels[seq_len(n_t)], times = length(ok)))
   colnames(export_data) <- c("Line",i,"Month","Year")
   write.csv(export_data,paste0(paste0("C:\\Users\\ian03\\Desktop\\TerraClimate-1001Genome\\arabidopsis_",i),"_data.csv"), row.names = FALSE)
+  # only ever hold one variable in memory, drop it before the worker picks up another
+  rm(cell_data, export_data)
+  print(paste0("Done with ",i))
   #print(paste0('writing '),paste0(paste0("C:\\Users\\ian03\\Desktop\\TerraClimate-1001Genome\\TerraClimate-1001Genome\\arabidopsis_",i),"_data.csv"))
-}
\ No newline at end of file
+}
+
+# every variable is its own url and its own csv, so pull them all side by side.
+# the workers mostly sit waiting on the server so one per variable is fine
+cl <- makeCluster(length(vars), outfile = "")
+invisible(clusterEvalQ(cl, library('ncdf4')))
+clusterExport(cl, c("arabidopsis_data","latindex","lonindex","no_cell","cell","first_in_cell","cache_dir","month_labels","year_labels"))
+invisible(parLapply(cl, vars, pull_variable))
+stopCluster(cl)